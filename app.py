@@ -1,167 +1,529 @@
 import os  # 匯入作業系統相關函式（讀環境變數等）
-import traceback  # 匯入 traceback 用來印出完整錯誤堆疊
-from flask import Flask, request, abort, jsonify  # 從 Flask 匯入 Web 相關物件與方法
+import logging  # 匯入 logging 記錄錯誤
+import logging.handlers  # 匯入 QueueHandler / QueueListener 讓格式化與輸出在背景執行緒進行
+import queue  # 匯入 queue 作為日誌佇列
+from flask import Flask, Response, request, abort  # 從 Flask 匯入 Web 相關物件與方法
 from linebot import LineBotApi, WebhookHandler  # 匯入 LINE Bot API 與 Webhook 處理器
 from linebot.exceptions import InvalidSignatureError  # 匯入 LINE 簽章驗證錯誤例外
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse  # 匯入 LINE SDK 預設的 requests HTTP client 以便改用共用連線池
 from linebot.models import (  # 匯入各種 LINE 訊息與事件的模型類別
     MessageEvent, TextMessage, TextSendMessage,
     PostbackEvent, MemberJoinedEvent, FollowEvent,
     QuickReply, QuickReplyButton, MessageAction
 )
 import google.generativeai as genai  # 匯入 Google Generative AI SDK 並簡寫為 genai
-from datetime import datetime  # 匯入 datetime 以取得時間
-from collections import OrderedDict  # 匯入 OrderedDict 以保留插入順序的字典
-import psutil  # 匯入 psutil 取得系統資源使用狀況
+import json  # 匯入 json 序列化送往 LINE API 的訊息內容
+import orjson  # 匯入 orjson 快速輸出 JSON
+import unicodedata  # 匯入 unicodedata 做 Unicode 正規化
+import time  # 匯入 time 判斷 reply token 是否逾時
+import hashlib  # 匯入 hashlib 產生快取鍵的雜湊與簽章驗證
+import hmac  # 匯入 hmac 驗證 LINE 簽章
+import base64  # 匯入 base64 編碼簽章
+import threading  # 匯入 threading 以鎖保護多執行緒共用的快取
+from collections import deque  # 匯入 deque 保存每個對話等待中的工作
+from functools import partial  # 匯入 partial 把訊息與參數綁成對話工作
+from cachetools import TTLCache  # 匯入有容量上限與逾時失效的快取
+from cachetools.func import ttl_cache  # 匯入函式結果的 TTL 快取裝飾器
+from concurrent.futures import Future, ThreadPoolExecutor  # 匯入執行緒池，把 Gemini 呼叫移出 webhook 執行緒
+import requests  # 匯入 requests 建立可重用連線的 Session
+from requests.adapters import HTTPAdapter  # 匯入 HTTPAdapter 設定連線池大小
+from urllib3.util.retry import Retry  # 匯入 Retry 設定連線失敗時的重試策略
 
 app = Flask(__name__)  # 建立 Flask 應用程式實例
 
+# 日誌：呼叫端只把 LogRecord 放進佇列，格式化（含 traceback）與輸出都交給背景執行緒
+class DeferredQueueHandler(logging.handlers.QueueHandler):  # 預設的 QueueHandler 會在呼叫端先格式化，這裡改為原樣放入佇列
+    def prepare(self, record):
+        return record
+
+log_queue = queue.SimpleQueue()  # 日誌佇列
+logger = logging.getLogger("linebot")  # 本程式使用的 logger
+logger.setLevel(os.environ.get("LOGLEVEL", "WARNING").upper())  # 以環境變數 LOGLEVEL 控制輸出等級，預設只記錄 WARNING 以上
+logger.addHandler(DeferredQueueHandler(log_queue))
+logger.propagate = False  # 不再交給 root logger 重複輸出
+log_stream = logging.StreamHandler()  # 輸出到 stderr
+log_stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+log_listener = logging.handlers.QueueListener(log_queue, log_stream)  # 背景執行緒負責格式化並寫出
+log_listener.start()
+
+# 共用 HTTP 連線池（keep-alive，避免每次呼叫 LINE API 都重新做 TCP/TLS 握手）
+SESSION = requests.Session()  # 全程共用的 requests Session
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=32,  # 快取的連線池數量（每個主機一個）
+    pool_maxsize=32,  # 每個連線池保留的最大連線數（與背景執行緒數同量級）
+    max_retries=Retry(  # 連線錯誤，或 GET 等冪等請求遇到 429/5xx 時最多重試 2 次（reply/push 為 POST，不會因狀態碼重送）
+        total=2,
+        backoff_factor=0.2,
+        status_forcelist=[429, 500, 502, 503, 504],
+        raise_on_status=False,  # 重試用盡時回傳最後的回應，讓 LINE SDK 照常拋出 LineBotApiError
+        respect_retry_after_header=False  # 不依 Retry-After 在 webhook 執行緒中長時間等待，只用 backoff_factor 的短暫間隔
+    )
+))
+
+class SessionHttpClient(RequestsHttpClient):  # 改用共用 SESSION 發送請求的 LINE HTTP client
+    def __init__(self, session, timeout=RequestsHttpClient.DEFAULT_TIMEOUT):
+        super().__init__(timeout=timeout)
+        self.session = session  # 保存共用的 requests Session
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        response = self.session.get(url, headers=headers, params=params, stream=stream,
+                                    timeout=self.timeout if timeout is None else timeout)
+        return RequestsHttpResponse(response)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        response = self.session.post(url, headers=headers, data=data,
+                                     timeout=self.timeout if timeout is None else timeout)
+        return RequestsHttpResponse(response)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        response = self.session.delete(url, headers=headers, data=data,
+                                       timeout=self.timeout if timeout is None else timeout)
+        return RequestsHttpResponse(response)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        response = self.session.put(url, headers=headers, data=data,
+                                    timeout=self.timeout if timeout is None else timeout)
+        return RequestsHttpResponse(response)
+
 # 初始化 LINE Bot
-line_bot_api = LineBotApi(os.getenv('CHANNEL_ACCESS_TOKEN'))  # 用環境變數中的 CHANNEL_ACCESS_TOKEN 建立 LineBotApi
-handler = WebhookHandler(os.getenv('CHANNEL_SECRET'))  # 用環境變數中的 CHANNEL_SECRET 建立 WebhookHandler
+CHANNEL_ACCESS_TOKEN = os.getenv('CHANNEL_ACCESS_TOKEN')  # 從環境變數讀取 Channel Access Token
+line_bot_api = LineBotApi(  # 用 CHANNEL_ACCESS_TOKEN 建立 LineBotApi
+    CHANNEL_ACCESS_TOKEN,
+    timeout=5,  # LINE API 逾時 5 秒
+    http_client=partial(SessionHttpClient, SESSION)  # SDK 會自行以 http_client(timeout=...) 建立 client，這裡綁定共用連線池
+)
+CHANNEL_SECRET = os.getenv('CHANNEL_SECRET')  # 從環境變數讀取 Channel Secret
+handler = WebhookHandler(CHANNEL_SECRET)  # 用 CHANNEL_SECRET 建立 WebhookHandler
+CHANNEL_SECRET_BYTES = (CHANNEL_SECRET or "").encode("utf-8")  # 預先轉成 bytes 供簽章驗證使用
 
-# 初始化 Gemini API
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))  # 使用環境變數中的 GEMINI_API_KEY 設定 Gemini API 金鑰
-GEMINI_MODEL_NAME = "gemini-2.5-flash-lite"  # 指定使用的 Gemini 模型名稱
-gemini_model = genai.GenerativeModel(GEMINI_MODEL_NAME)  # 建立指定模型的 GenerativeModel 實例
+# 直接以共用 SESSION 呼叫 LINE Messaging API（訊息預先序列化成 JSON，略過 SDK 每次的序列化）
+LINE_API_ENDPOINT = "https://api.line.me"  # LINE Messaging API 網址
+LINE_HEADERS = {
+    "Authorization": f"Bearer {CHANNEL_ACCESS_TOKEN}",  # 以 Channel Access Token 驗證
+    "Content-Type": "application/json"
+}
+PUSH_MAX_MESSAGES = 5  # LINE 每次 reply / push 最多 5 則訊息
+REPLY_TOKEN_WINDOW = 50  # reply token 約 1 分鐘內有效；事件發生超過 50 秒後改用 push
+
+def post_line_json(path, data):  # 將已組好的 JSON 字串 POST 到 LINE API
+    response = SESSION.post(LINE_API_ENDPOINT + path, headers=LINE_HEADERS, data=data.encode("utf-8"), timeout=5)
+    response.raise_for_status()  # 非 2xx 時拋出例外，交由呼叫端處理
+
+def post_reply(reply_token, messages):  # 以預先序列化的訊息 JSON 清單回覆
+    post_line_json("/v2/bot/message/reply", '{"replyToken":%s,"messages":[%s]}' % (json.dumps(reply_token), ",".join(messages)))
+
+def post_push(to, messages):  # 以預先序列化的訊息 JSON 清單推播
+    post_line_json("/v2/bot/message/push", '{"to":%s,"messages":[%s]}' % (json.dumps(to), ",".join(messages)))
+
+def message_json(message):  # 將 SDK 的訊息物件序列化成 JSON 字串（固定訊息只在啟動時做一次）
+    return json.dumps(message.as_json_dict(), ensure_ascii=False)
+
+# 送出佇列：webhook 與 Gemini 執行緒只把訊息放進佇列，由背景執行緒送出
+# 同一對話固定由同一條送出執行緒處理以維持順序，不同對話則平行送出，避免一次緩慢的 LINE 呼叫卡住所有人
+SEND_WORKERS = 8  # 送出執行緒數（每條各自使用共用連線池中的連線）
+send_queues = [queue.SimpleQueue() for _ in range(SEND_WORKERS)]  # 每條送出執行緒的佇列，項目為 ("reply" 或 "push", reply token 或對象, 訊息 JSON 清單, reply 失效時改 push 的 (對象, 期限))
+
+def send_queue_for(key):  # 依對話（或 reply token）選出固定的送出佇列
+    return send_queues[hash(key) % SEND_WORKERS]
 
-# 載入 Prompt 模板（只讀一次）
+def send_reply(reply_token, serialized, to=None, deadline=None):  # 排入一則回覆（不等待 LINE API）；有 to 時，超過 deadline 或 reply 失敗就改用 push
+    send_queue_for(to or reply_token).put_nowait(("reply", reply_token, [serialized], (to, deadline) if to else None))
+
+def send_push(to, serialized):  # 排入一則推播（不等待 LINE API）
+    send_queue_for(to).put_nowait(("push", to, [serialized], None))
+
+def send_worker(send_queue):  # 背景執行緒：依序送出佇列中的訊息，相鄰且對象相同的 push 合併成一次呼叫
+    while True:
+        items = [send_queue.get()]  # 等待第一則訊息
+        while True:
+            try:
+                items.append(send_queue.get_nowait())  # 一併取出目前已排隊的訊息
+            except queue.Empty:
+                break
+        i = 0
+        while i < len(items):
+            kind, target, messages, fallback = items[i]
+            messages = list(messages)
+            i += 1
+            if kind == "push":
+                while (i < len(items) and items[i][0] == "push" and items[i][1] == target
+                       and len(messages) + len(items[i][2]) <= PUSH_MAX_MESSAGES):
+                    messages.extend(items[i][2])  # 合併同一對象的下一次 push
+                    i += 1
+            try:
+                if kind == "push":
+                    post_push(target, messages)
+                elif fallback and fallback[1] is not None and time.time() > fallback[1]:
+                    post_push(fallback[0], messages)  # reply token 可能已過期，直接改用 push
+                else:
+                    try:
+                        post_reply(target, messages)
+                    except requests.HTTPError:
+                        if not fallback:
+                            raise
+                        post_push(fallback[0], messages)  # reply token 無效（例如已過期）時改用 push
+            except Exception:
+                logger.exception("LINE %s failed", kind)  # 送出失敗只記錄，不影響後續訊息
+
+for q in send_queues:
+    threading.Thread(target=send_worker, args=(q,), daemon=True).start()  # 啟動送出背景執行緒
+
+# 載入 Prompt 模板（只在啟動時讀一次，之後每次呼叫直接使用 PROMPT_TEMPLATE）
+PROMPT_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompt_config.md")  # 以本檔所在目錄定位模板，不受啟動時工作目錄影響
 try:
-    with open("prompt_config.md", "r", encoding="utf-8") as f:  # 嘗試讀取本地的 prompt_config.md 作為提示模板
+    with open(PROMPT_CONFIG_PATH, "r", encoding="utf-8") as f:  # 嘗試讀取 prompt_config.md 作為提示模板
         PROMPT_TEMPLATE = f.read().strip()  # 讀入檔案內容並去除前後空白儲存到 PROMPT_TEMPLATE
 except Exception:
     PROMPT_TEMPLATE = ""  # 若讀檔發生錯誤就使用空字串作為預設模板
 
-# 使用者狀態管理（限制最大容量）
-user_status = OrderedDict()  # 使用 OrderedDict 保存使用者狀態（可做 LRU 式管理）
+# 初始化 Gemini API
+genai.configure(api_key=os.getenv("GEMINI_API_KEY"))  # 使用環境變數中的 GEMINI_API_KEY 設定 Gemini API 金鑰
+GEMINI_MODEL_NAME = "gemini-2.5-flash-lite"  # 指定使用的 Gemini 模型名稱
+gemini_model = genai.GenerativeModel(  # 建立指定模型的 GenerativeModel 實例（全程共用，只建一次）
+    GEMINI_MODEL_NAME,
+    system_instruction=PROMPT_TEMPLATE or None  # 固定的 PROMPT_TEMPLATE 作為系統指令，與每次變動的使用者內容分開
+)
+
+# Gemini 生成參數與安全性設定（固定不變，只建一次）
+GENERATION_CONFIG = {
+    "temperature": 0.4,  # 溫度較低，使回答較穩定
+    "max_output_tokens": 600,  # 回應最大 token 數
+    "top_p": 0.9,  # nucleus sampling 參數
+    "top_k": 40  # 最多考慮的候選詞數
+}
+SAFETY_SETTINGS = [  # 安全性設定，避免產出有害內容
+    {"category": "HARM_CATEGORY_SEXUAL", "threshold": 3},
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": 3},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": 3},
+    {"category": "HARM_CATEGORY_DANGEROUS", "threshold": 3}
+]
+
+# 使用者狀態管理（限制最大容量，閒置逾時自動失效）
 MAX_USERS = 1000  # 最多紀錄 1000 位使用者狀態
+USER_STATUS_TTL = 1800  # 使用者閒置 30 分鐘後狀態自動失效
+user_status = TTLCache(maxsize=MAX_USERS, ttl=USER_STATUS_TTL)  # 使用 TTLCache 保存使用者狀態（超過容量時移除最久未用的）
+user_status_lock = threading.Lock()  # 多執行緒同時讀寫使用者狀態時需上鎖
+
+# 背景執行緒池（Gemini 呼叫耗時數秒，不佔用 webhook 的工作執行緒）
+GEMINI_WORKERS = 16  # 同時處理 Gemini 請求的最大執行緒數
+executor = ThreadPoolExecutor(max_workers=GEMINI_WORKERS)  # 建立背景執行緒池
+
+# 每個對話（個人、群組或聊天室）的待處理工作佇列：同一對話一次只執行一個工作，完成後才送出下一個，
+# 讓回覆依訊息順序送出，且不會有執行緒為了等待前一個工作而閒置佔用執行緒池
+conversation_turns = {}  # 對象 ID → 等待中的工作（有此鍵表示該對話已有工作在執行）
+conversation_turns_lock = threading.Lock()
+
+def enqueue_turn(to, job):  # 排入一個對話工作；該對話沒有工作在執行時立即送進執行緒池
+    with conversation_turns_lock:
+        waiting = conversation_turns.get(to)
+        if waiting is not None:
+            waiting.append(job)  # 等前一個工作完成後再執行
+            return
+        conversation_turns[to] = deque()
+    run_turn(to, job)
+
+def run_turn(to, job):  # 把工作送進執行緒池，完成後接著執行同一對話的下一個工作
+    try:
+        future = executor.submit(job)
+    except RuntimeError:  # 執行緒池已關閉（行程結束中），清除此對話的紀錄
+        with conversation_turns_lock:
+            conversation_turns.pop(to, None)
+        raise
+    future.add_done_callback(lambda f: next_turn(to))
+
+def reply_in_turn(to, send):  # 同一對話有工作在執行或等待時，把送出排在其後；否則直接送出（不佔用執行緒池）
+    with conversation_turns_lock:
+        waiting = conversation_turns.get(to)
+        if waiting is not None:
+            waiting.append(send)
+            return
+    send()
+
+def next_turn(to):  # 前一個工作完成：取出同一對話的下一個工作，沒有則移除紀錄
+    with conversation_turns_lock:
+        waiting = conversation_turns[to]
+        if not waiting:
+            del conversation_turns[to]
+            return
+        job = waiting.popleft()
+    run_turn(to, job)
 
 def set_user_status(uid, status):  # 設定特定使用者的狀態
-    if uid in user_status:  # 如果使用者已存在於狀態字典
-        user_status.move_to_end(uid)  # 將該使用者移到 OrderedDict 末端（視為最近使用）
-    user_status[uid] = status  # 更新或新增使用者狀態
-    if len(user_status) > MAX_USERS:  # 如果超過最大容量
-        user_status.popitem(last=False)  # 移除最前面的舊使用者（last=False 代表從頭部 pop）
+    with user_status_lock:
+        user_status[uid] = status  # 更新或新增使用者狀態（重新計算失效時間）
+
+def get_user_status(uid):  # 取得特定使用者的狀態，並延長其失效時間
+    with user_status_lock:
+        status = user_status.get(uid)
+        if status is not None:
+            user_status[uid] = status  # 重新寫入，讓閒置時間從這次互動開始計算
+        return status
+
+def clear_user_status(uid):  # 移除特定使用者的狀態，回傳移除前的狀態
+    with user_status_lock:
+        return user_status.pop(uid, None)
+
+# Gemini 回應快取（以正規化後的提示雜湊為鍵，總位元組數有上限且逾時自動失效）
+RESPONSE_CACHE_BYTES = 4 * 1024 * 1024  # 快取的回應文字總量上限 4 MB（以 UTF-8 位元組計）
+RESPONSE_CACHE_TTL = 3600  # 每筆回應最多保留 1 小時
+response_cache = TTLCache(  # 建立 TTL 快取，容量以回應的位元組數計算而非筆數
+    maxsize=RESPONSE_CACHE_BYTES,
+    ttl=RESPONSE_CACHE_TTL,
+    getsizeof=lambda answer: len(answer.encode("utf-8"))
+)
+response_cache_lock = threading.Lock()  # 多執行緒同時讀寫快取時需上鎖
+
+def response_cache_key(text):  # 將提示正規化（Unicode NFC、去頭尾空白、合併連續空白）後取雜湊作為快取鍵；保留大小寫，翻譯模式的文法建議會因大小寫而不同
+    normalized = " ".join(unicodedata.normalize("NFC", text).split())  # NFC 統一組合字元寫法；split() 會一併去除頭尾並合併所有空白字元
+    return hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).digest()  # 16 bytes 雜湊，鍵長固定不隨提示變大
+
+def get_cached_response(text):  # 查詢快取，未命中回傳 None
+    key = response_cache_key(text)  # 計算此提示的快取鍵
+    with response_cache_lock:
+        return response_cache.get(key)
+
+def cache_response(text, answer):  # 將成功的回應寫入快取
+    key = response_cache_key(text)  # 計算此提示的快取鍵
+    with response_cache_lock:
+        response_cache[key] = answer
+
+GEMINI_ERROR_TEXT = "⚠️ AI 回應發生錯誤，請稍後再試或檢查 API 金鑰。"  # Gemini 呼叫失敗時給使用者的訊息
+
+def GPT_response(text):  # 封裝呼叫 Gemini 模型產生回覆的函式（含回應快取）
+    cached = get_cached_response(text)  # 查詢快取
+    if cached is not None:
+        return cached  # 快取命中就直接回傳，不呼叫 Gemini
 
-def GPT_response(text):  # 封裝呼叫 Gemini 模型產生回覆的函式
     try:
-        prompt = f"{PROMPT_TEMPLATE}\n\n{text.strip()}"  # 將預設 PROMPT_TEMPLATE 與使用者輸入內容組成完整提示
+        prompt = text.strip()  # PROMPT_TEMPLATE 已是系統指令，這裡只送出變動的內容
         response = gemini_model.generate_content(  # 呼叫 Gemini 產生內容
             prompt,
-            generation_config={  # 設定生成參數
-                "temperature": 0.4,  # 溫度較低，使回答較穩定
-                "max_output_tokens": 600,  # 回應最大 token 數
-                "top_p": 0.9,  # nucleus sampling 參數
-                "top_k": 40  # 最多考慮的候選詞數
-            },
-            safety_settings=[  # 安全性設定，避免產出有害內容
-                {"category": "HARM_CATEGORY_SEXUAL", "threshold": 3},
-                {"category": "HARM_CATEGORY_HARASSMENT", "threshold": 3},
-                {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": 3},
-                {"category": "HARM_CATEGORY_DANGEROUS", "threshold": 3}
-            ]
+            generation_config=GENERATION_CONFIG,  # 使用模組層級的生成參數
+            safety_settings=SAFETY_SETTINGS  # 使用模組層級的安全性設定
         )
-        return response.text.strip()  # 回傳模型回應的純文字並去除前後空白
+        usage = getattr(response, "usage_metadata", None)  # 取得 token 用量資訊
+        if usage is not None:
+            logger.debug("Gemini cached tokens: %s", getattr(usage, "cached_content_token_count", 0))  # 記錄命中隱式快取的 token 數
+        answer = response.text.strip()  # 取出模型回應的純文字並去除前後空白
     except Exception as e:
-        print("[Gemini ERROR]", e)  # 若呼叫失敗，在伺服器端印出錯誤訊息
-        return "⚠️ AI 回應發生錯誤，請稍後再試或檢查 API 金鑰。"  # 回傳給使用者的錯誤訊息
+        logger.error("Gemini error: %s", e)  # 若呼叫失敗，在伺服器端記錄錯誤訊息
+        return GEMINI_ERROR_TEXT  # 回傳給使用者的錯誤訊息（不寫入快取）
+
+    cache_response(text, answer)  # 成功的回應才寫入快取
+    return answer
+
+# 相同提示的進行中呼叫只送一次（single-flight），其他呼叫者等待同一個 Future
+in_flight = {}  # 快取鍵 → 進行中呼叫的 Future
+in_flight_lock = threading.Lock()
+
+def release_flight(key, future):  # 呼叫完成時移除紀錄（結果已寫入快取，之後的呼叫者直接命中快取）
+    with in_flight_lock:
+        if in_flight.get(key) is future:
+            del in_flight[key]
 
-def handle_translation_mode(msg):  # 處理「翻譯小助理」模式的函式
-    prompt = f"""請對以下內容做詳細處理：
+def claim_flight(text):  # 加入相同提示的進行中呼叫，或登記新的呼叫；回傳 (Future, 是否由本次負責呼叫 Gemini)
+    key = response_cache_key(text)
+    with in_flight_lock:
+        flight = in_flight.get(key)
+        if flight is not None:
+            return flight, False
+        flight = Future()
+        in_flight[key] = flight
+    flight.add_done_callback(lambda f: release_flight(key, f))
+    return flight, True
+
+def shared_response(text):  # 與 GPT_response 相同，但相同提示同時只呼叫一次 Gemini（會阻塞直到取得回覆）
+    cached = get_cached_response(text)  # 快取命中就不呼叫 Gemini
+    if cached is not None:
+        return cached
+    flight, leader = claim_flight(text)
+    if not leader:
+        return flight.result()  # 相同提示已在進行中，等待其結果
+    try:
+        answer = GPT_response(text)
+    except Exception as e:
+        flight.set_exception(e)  # 讓等待中的呼叫者收到例外，避免永久阻塞
+        raise
+    flight.set_result(answer)
+    return answer
+
+# 固定不變的指令放在提示最前面、使用者內容放最後，讓 Gemini 隱式快取能命中相同前綴
+TRANSLATE_PREFIX = """請對以下內容做詳細處理：
 
 1. 中英文對照翻譯
 2. 用字與文法優化建議
 
-原文：{msg}
+請限制回覆在 300 字內，並以條列方式回答，格式清楚易讀。
+
+原文："""
 
-請限制回覆在 300 字內，並以條列方式回答，格式清楚易讀。"""
-    return GPT_response(prompt)  # 將組好的翻譯提示丟給 GPT_response 取得回覆
+# 各使用者模式的提示前綴（新增模式只需在此登記；不在表中的狀態視為一般問答，直接送出使用者輸入）
+MODE_PREFIXES = {
+    "translating": TRANSLATE_PREFIX  # 翻譯小助理
+}
+
+def build_prompt(msg, mode):  # 依使用者模式組成要送給 Gemini 的提示
+    return MODE_PREFIXES.get(mode, "") + msg  # 一般問答的字數與語氣限制已在系統指令 PROMPT_TEMPLATE 中，快取鍵只看使用者輸入
+
+def valid_signature(raw, signature):  # 以 HMAC-SHA256 驗證 LINE 簽章（固定時間比較）
+    mac = hmac.new(CHANNEL_SECRET_BYTES, raw, hashlib.sha256).digest()  # 以 Channel Secret 計算 body 的 HMAC
+    return hmac.compare_digest(base64.b64encode(mac), signature.encode("utf-8"))  # 與 Header 中的簽章比較
 
 @app.route("/callback", methods=['POST'])  # 定義 LINE Webhook callback 路由，只接受 POST
 def callback():
     signature = request.headers.get('X-Line-Signature', '')  # 從 HTTP Header 取得 X-Line-Signature 驗證簽章
-    body = request.get_data(as_text=True)  # 取得請求的原始 body 文字
-    app.logger.info("Request body: " + body)  # 將請求 body 記錄到 log
+    if not signature:  # 沒有簽章就直接拒絕，連 body 都不讀
+        abort(400)
+    raw = request.get_data()  # 取得請求的原始 body bytes（先不解碼）
+    if not valid_signature(raw, signature):  # 先驗證簽章，偽造或無效的請求不做解碼與記錄
+        abort(400)
+    body = raw.decode("utf-8")  # 驗證通過後才解碼
+    logger.debug("Request body: %s", body)  # 只在 LOGLEVEL=DEBUG 時記錄請求 body（延遲格式化）
     try:
-        handler.handle(body, signature)  # 交給 WebhookHandler 驗證簽章並分派事件
+        payload = orjson.loads(raw)  # 只解析一次 JSON
+    except orjson.JSONDecodeError:
+        abort(400)
+    if not isinstance(payload, dict):  # 合法 JSON 但不是物件，不是有效的 webhook
+        abort(400)
+    events = payload.get("events") or []
+    if all(is_text_message(ev) for ev in events):  # 全部都是文字訊息時直接分派，不經 SDK 再解析一次並建立事件物件
+        for ev in events:
+            handle_text_event(ev)
+        return 'OK'
+    try:
+        handler.handle(body, signature)  # 其他事件交給 WebhookHandler 驗證簽章並分派事件
     except InvalidSignatureError:
         abort(400)  # 簽章驗證失敗就回傳 400 Bad Request
     return 'OK'  # 驗證成功並處理事件後回傳 OK
 
+# /ping 的記憶體量測（Linux 直接讀 /proc/self/statm，且每 30 秒最多實際量測一次）
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096  # 記憶體分頁大小（bytes）
+MEMORY_PROBE_INTERVAL = 30  # 記憶體量測的最短間隔（秒）
+last_memory_probe = None  # 上次量測的時間（time.monotonic()）
+last_memory_mb = 0.0  # 上次量測的 RSS（MB）
+
+def read_rss_mb():  # 讀取目前行程的 RSS（MB）
+    try:
+        with open("/proc/self/statm") as f:  # 第二個欄位是常駐記憶體的分頁數
+            return int(f.read().split()[1]) * PAGE_SIZE / 1024 / 1024
+    except OSError:  # 非 Linux 沒有 /proc，改用 psutil
+        import psutil
+        return psutil.Process().memory_info().rss / 1024 / 1024
+
+def memory_mb():  # 回傳目前行程的 RSS（MB），間隔內直接使用上次的結果
+    global last_memory_probe, last_memory_mb
+    now = time.monotonic()
+    if last_memory_probe is None or now - last_memory_probe >= MEMORY_PROBE_INTERVAL:
+        last_memory_mb = round(read_rss_mb(), 2)  # 取得記憶體使用量 (RSS) 並轉成 MB
+        last_memory_probe = now
+    return last_memory_mb
+
 @app.route("/ping", methods=["GET"])  # 健康檢查路由，用 GET 呼叫 /ping
 def ping():
-    now = datetime.utcnow().isoformat()  # 使用 UTC 時區取得現在時間並轉成 ISO 字串
-    mem = psutil.Process(os.getpid()).memory_info().rss / 1024 / 1024  # 取得目前行程記憶體使用量 (RSS) 並轉成 MB
-    return jsonify({"status": "ok", "timestamp": now, "memory_MB": round(mem, 2)}), 200  # 回傳 JSON 狀態與 HTTP 200
+    now = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime())  # UTC 現在時間的 ISO 字串
+    return Response(orjson.dumps({"status": "ok", "timestamp": now, "memory_MB": memory_mb()}), status=200, mimetype="application/json")  # 以 orjson 直接輸出 bytes，回傳 JSON 狀態與 HTTP 200
+
+CMD_START = "啟動翻譯小助理"  # 啟動翻譯模式的指令文字
+CMD_STOP = "結束翻譯小助理"  # 結束翻譯模式的指令文字
+
+QUICK_REPLY = QuickReply(items=[  # 預設的 quick reply 按鈕（內容固定，只建一次並重複使用）
+    QuickReplyButton(action=MessageAction(label="翻譯小助理", text=CMD_START)),  # 點擊後送出啟動指令
+    QuickReplyButton(action=MessageAction(label="結束翻譯小助理", text=CMD_STOP)),  # 點擊後送出結束指令
+])
 
-def quick_reply_buttons():  # 建立預設的 quick reply 按鈕
-    return QuickReply(items=[
-        QuickReplyButton(action=MessageAction(label="翻譯小助理", text="啟動翻譯小助理")),  # 點擊後送出文字「啟動翻譯小助理」
-        QuickReplyButton(action=MessageAction(label="結束翻譯小助理", text="結束翻譯小助理")),  # 點擊後送出文字「結束翻譯小助理」
-    ])
+# 固定內容的回覆訊息（啟動時預先序列化成 JSON，之後直接重複使用）
+MSG_START = message_json(TextSendMessage(text="已啟動翻譯小助理！請輸入想要翻譯的內容。", quick_reply=QUICK_REPLY))  # 開啟翻譯模式
+MSG_STOP = message_json(TextSendMessage(text="已退出翻譯小助理功能。", quick_reply=QUICK_REPLY))  # 退出翻譯模式
+MSG_NOT_TRANSLATING = message_json(TextSendMessage(text="你目前不在翻譯小助理模式。", quick_reply=QUICK_REPLY))  # 目前沒有啟用翻譯模式
+MSG_ERROR = message_json(TextSendMessage(text='AI 回應發生錯誤，請檢查伺服器 Log 或 API 金鑰。', quick_reply=QUICK_REPLY))  # 通用錯誤提示
+MSG_FOLLOW = message_json(TextSendMessage(text="歡迎使用本 Bot，請點選下方按鈕開始。", quick_reply=QUICK_REPLY))  # 新追蹤者的歡迎訊息
+
+def text_message(text):  # 將 Gemini 產生的文字包成附 quick reply 按鈕的訊息 JSON
+    return message_json(TextSendMessage(text=text, quick_reply=QUICK_REPLY))
+
+def generate_and_reply(reply_token, to, msg, mode, deadline):  # 在背景執行緒呼叫 Gemini 並回覆使用者（to 為 push 的對象）
+    try:
+        text = build_prompt(msg, mode)  # 以收到訊息當下的模式組成提示
+        reply_text = shared_response(text)  # 取得完整回覆（先查快取，相同提示同時只呼叫一次 Gemini）
+        send_reply(reply_token, text_message(reply_text), to, deadline)  # 回覆訊息給使用者（附上 quick reply 按鈕）
+
+    except Exception:
+        try:
+            send_reply(reply_token, MSG_ERROR, to, deadline)  # 先回覆通用錯誤提示
+        finally:
+            logger.exception("generate_and_reply failed")  # 再記錄完整錯誤堆疊（在背景執行緒格式化）
 
-@handler.add(MessageEvent, message=TextMessage)  # 當收到文字訊息事件時，由此 handler 處理
+def is_text_message(ev):  # 判斷 webhook 事件（JSON dict）是否為文字訊息
+    return (isinstance(ev, dict) and ev.get("type") == "message"
+            and isinstance(ev.get("message"), dict) and ev["message"].get("type") == "text")
+
+def handle_text_event(ev):  # 直接從 webhook JSON 取出需要的欄位處理文字訊息（欄位可能缺少，例如 standby 模式沒有 replyToken）
+    if ev.get("mode") == "standby" or not ev.get("replyToken"):  # standby 中的 channel 不應回應，也不呼叫 Gemini
+        return
+    source = ev.get("source") or {}  # 訊息來源（個人、群組或聊天室）
+    uid = source.get("userId")  # 觸發事件的使用者 ID
+    to = source.get("groupId") or source.get("roomId") or uid  # reply token 過期時改用 push 的對象
+    handle_message_core(uid, to, (ev["message"].get("text") or "").strip(), ev.get("replyToken"), ev.get("timestamp"))
+
+@handler.add(MessageEvent, message=TextMessage)  # 當收到文字訊息事件時，由此 handler 處理（混有其他事件時經由 SDK 分派）
 def handle_message(event):
+    if getattr(event, "mode", None) == "standby" or not event.reply_token:  # 與直接分派相同：standby 中不回應
+        return
     uid = event.source.user_id  # 取得觸發事件的使用者 ID
-    msg = event.message.text.strip()  # 取得使用者輸入的文字並去除前後空白
+    source = event.source  # 訊息來源（個人、群組或聊天室）
+    to = getattr(source, "group_id", None) or getattr(source, "room_id", None) or uid  # reply token 過期時改用 push 的對象
+    handle_message_core(uid, to, event.message.text.strip(), event.reply_token, event.timestamp)
 
+def handle_message_core(uid, to, msg, reply_token, timestamp):  # 處理一則文字訊息（msg 已去除前後空白，timestamp 為毫秒，可能為 None）
     try:
-        if msg == "啟動翻譯小助理":  # 若使用者輸入啟動指令
+        deadline = timestamp / 1000 + REPLY_TOKEN_WINDOW if timestamp else None  # reply token 的使用期限（事件時間為毫秒）
+        if msg == CMD_START:  # 若使用者輸入啟動指令
             set_user_status(uid, "translating")  # 將該使用者狀態設為 translating
-            reply_text = "已啟動翻譯小助理！請輸入想要翻譯的內容。"  # 回覆開啟翻譯模式訊息
+            reply = MSG_START  # 回覆開啟翻譯模式訊息
 
-        elif msg == "結束翻譯小助理":  # 若使用者輸入結束指令
-            if user_status.get(uid) == "translating":  # 判斷目前是否處於翻譯模式
-                user_status.pop(uid, None)  # 從狀態管理中移除該使用者紀錄
-                reply_text = "已退出翻譯小助理功能。"  # 告知使用者已退出翻譯模式
+        elif msg == CMD_STOP:  # 若使用者輸入結束指令
+            if clear_user_status(uid) == "translating":  # 移除該使用者紀錄，並判斷原本是否處於翻譯模式
+                reply = MSG_STOP  # 告知使用者已退出翻譯模式
             else:
-                reply_text = "你目前不在翻譯小助理模式。"  # 告知目前沒有啟用翻譯模式
-
-        elif user_status.get(uid) == "translating":  # 若使用者目前狀態為翻譯模式
-            reply_text = handle_translation_mode(msg)  # 將使用者訊息丟給翻譯模式處理
+                reply = MSG_NOT_TRANSLATING  # 告知目前沒有啟用翻譯模式
 
-        else:  # 其他一般文字訊息處理
-            prompt = f"""請針對以下內容簡短回覆，限 300 字內：
+        else:  # 需要呼叫 Gemini 的訊息交給背景執行緒，webhook 立即回 200
+            mode = get_user_status(uid)  # 以收到訊息當下的狀態決定模式
+            enqueue_turn(to, partial(generate_and_reply, reply_token, to, msg, mode, deadline))  # 依對話順序排入背景執行緒處理
+            return
 
-使用者輸入：{msg}"""
-            reply_text = GPT_response(prompt)  # 使用 GPT_response 產生一般問答回覆
-
-        line_bot_api.reply_message(  # 回覆訊息給使用者
-            event.reply_token,
-            TextSendMessage(text=reply_text, quick_reply=quick_reply_buttons())  # 附上 quick reply 按鈕
-        )
+        reply_in_turn(to, partial(send_reply, reply_token, reply, to, deadline))  # 回覆預先序列化的固定訊息（排在同一對話進行中的工作之後）
 
     except Exception:
-        print(traceback.format_exc())  # 若處理訊息時發生任何錯誤，印出完整錯誤堆疊
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text='AI 回應發生錯誤，請檢查伺服器 Log 或 API 金鑰。', quick_reply=quick_reply_buttons())  # 回覆通用錯誤提示
-        )
+        try:
+            send_reply(reply_token, MSG_ERROR)  # 先回覆通用錯誤提示
+        finally:
+            logger.exception("handle_message failed")  # 再記錄完整錯誤堆疊（在背景執行緒格式化）
 
 @handler.add(PostbackEvent)  # 監聽處理 Postback 事件
 def handle_postback(event):
-    print(f"Postback data: {event.postback.data}")  # 將 Postback 的 data 內容印出（目前只做記錄，不做邏輯）
+    logger.info("Postback data: %s", event.postback.data)  # 記錄 Postback 的 data 內容（目前只做記錄，不做邏輯）
+
+@ttl_cache(maxsize=2048, ttl=3600)  # 以 (群組 ID, 使用者 ID) 快取 1 小時；API 失敗時不會寫入快取
+def display_name(gid, uid):  # 透過 API 取得該成員在群組中的顯示名稱
+    return line_bot_api.get_group_member_profile(gid, uid).display_name
 
 @handler.add(MemberJoinedEvent)  # 監聽群組新成員加入事件
 def welcome(event):
     uid = event.joined.members[0].user_id  # 取得新加入成員的 user_id（假設第一個為新成員）
     gid = event.source.group_id  # 取得觸發事件的群組 ID
-    profile = line_bot_api.get_group_member_profile(gid, uid)  # 透過 API 取得該成員在群組中的個人資料
-    name = profile.display_name  # 取得顯示名稱
+    name = display_name(gid, uid)  # 取得顯示名稱（短時間內重複加入不再呼叫 API）
     message = TextSendMessage(
         text=f'{name} 歡迎加入！目前作者屬於個人工作！請多多指教！',  # 建立歡迎訊息文字
-        quick_reply=quick_reply_buttons()  # 附上 quick reply 按鈕
+        quick_reply=QUICK_REPLY  # 附上 quick reply 按鈕
     )
-    line_bot_api.reply_message(event.reply_token, message)  # 回覆歡迎訊息到群組
+    send_reply(event.reply_token, message_json(message))  # 回覆歡迎訊息到群組
 
 @handler.add(FollowEvent)  # 監聽使用者加入好友/追蹤 Bot 的事件
 def handle_follow(event):
     user_id = event.source.user_id  # 取得新追蹤者的 user_id
-    message = TextSendMessage(
-        text="歡迎使用本 Bot，請點選下方按鈕開始。",  # 發送歡迎使用的文字
-        quick_reply=quick_reply_buttons()  # 附上 quick reply 按鈕
-    )
-    line_bot_api.push_message(user_id, message)  # 主動推播歡迎訊息給新追蹤者
+    send_push(user_id, MSG_FOLLOW)  # 主動推播歡迎訊息給新追蹤者
 
 if __name__ == "__main__":  # 當此檔案被直接執行時進入這裡
     port = int(os.environ.get('PORT', 5000))  # 從環境變數讀取 PORT，若沒有就預設 5000
-    app.run(host='0.0.0.0', port=port)  # 啟動 Flask 伺服器，對外監聽所有網路介面
+    app.run(host='0.0.0.0', port=port, threaded=True)  # 啟動 Flask 伺服器（多執行緒），對外監聽所有網路介面
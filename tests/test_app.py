@@ -0,0 +1,120 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import sys
+import time
+
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("linebot")
+pytest.importorskip("google.generativeai")
+
+os.environ.setdefault("CHANNEL_SECRET", "test-secret")  # 匯入 app 前先設定測試用金鑰
+os.environ.setdefault("CHANNEL_ACCESS_TOKEN", "test-token")
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as bot  # noqa: E402
+
+
+class FakeChunk:  # 模擬 Gemini 回應（一般呼叫與串流的每一段都有 text）
+    def __init__(self, text):
+        self.text = text
+        self.usage_metadata = None
+
+
+class FakeResponse:  # 模擬 requests 的回應
+    def raise_for_status(self):
+        pass
+
+
+@pytest.fixture
+def sent(monkeypatch):  # 攔截 LINE API 呼叫與 Gemini 呼叫，回傳送出的 (路徑, JSON) 清單
+    calls = []
+
+    def post(url, headers=None, data=None, timeout=None):
+        calls.append((url.rsplit("/", 1)[-1], json.loads(data)))
+        return FakeResponse()
+
+    def generate_content(prompt, stream=False, **kwargs):
+        answer = "答覆：" + prompt
+        return [FakeChunk(answer)] if stream else FakeChunk(answer)
+
+    monkeypatch.setattr(bot.SESSION, "post", post)
+    monkeypatch.setattr(bot.gemini_model, "generate_content", generate_content)
+    return calls
+
+
+def wait_for(calls, count):  # 等背景執行緒送出至少 count 次呼叫
+    deadline = time.time() + 5
+    while len(calls) < count and time.time() < deadline:
+        time.sleep(0.01)
+    return calls
+
+
+def post_events(events, secret=None):  # 以正確簽章 POST 到 /callback
+    body = json.dumps({"destination": "U0", "events": events}).encode("utf-8")
+    key = (secret or os.environ["CHANNEL_SECRET"]).encode("utf-8")
+    signature = base64.b64encode(hmac.new(key, body, hashlib.sha256).digest()).decode("utf-8")
+    return bot.app.test_client().post("/callback", data=body, headers={"X-Line-Signature": signature})
+
+
+def text_event(user_id, text, reply_token, **extra):  # 組一個文字訊息事件
+    event = {
+        "type": "message",
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "source": {"type": "user", "userId": user_id},
+        "webhookEventId": "E" + reply_token,
+        "deliveryContext": {"isRedelivery": False},
+        "replyToken": reply_token,
+        "message": {"id": "1", "type": "text", "text": text, "quoteToken": "q"},
+    }
+    event.update(extra)
+    return event
+
+
+def test_ping():
+    response = bot.app.test_client().get("/ping")
+    assert response.status_code == 200
+    assert response.get_json()["status"] == "ok"
+
+
+def test_callback_rejects_bad_signature(sent):
+    assert post_events([text_event("U1", "hello", "r1")], secret="wrong").status_code == 400
+    assert bot.app.test_client().post("/callback", data=b"{}").status_code == 400
+
+
+def test_callback_replies_with_gemini_answer(sent):
+    assert post_events([text_event("U2", "哈囉", "r2")]).status_code == 200
+    path, payload = wait_for(sent, 1)[0]
+    assert path == "reply"
+    assert payload["replyToken"] == "r2"
+    assert [m["text"] for m in payload["messages"]] == ["答覆：哈囉"]
+
+
+def test_command_reply_waits_for_pending_answer(sent, monkeypatch):
+    def slow_generate_content(prompt, stream=False, **kwargs):  # 讓前一則訊息的回答晚一點完成
+        time.sleep(0.2)
+        answer = "答覆：" + prompt
+        return [FakeChunk(answer)] if stream else FakeChunk(answer)
+
+    monkeypatch.setattr(bot.gemini_model, "generate_content", slow_generate_content)
+    events = [text_event("U3", "你好", "r3a"), text_event("U3", bot.CMD_START, "r3b")]
+    assert post_events(events).status_code == 200
+    replies = [payload["replyToken"] for _, payload in wait_for(sent, 2)]
+    bot.clear_user_status("U3")
+    assert replies == ["r3a", "r3b"]
+
+
+def test_standby_event_is_ignored(sent, monkeypatch):
+    calls = []
+    monkeypatch.setattr(bot.gemini_model, "generate_content", lambda *args, **kwargs: calls.append(args))
+    event = text_event("U4", "待命中", "r4", mode="standby")
+    del event["replyToken"]  # LINE 不會給 standby 事件 replyToken
+    assert post_events([event]).status_code == 200
+    time.sleep(0.2)
+    assert calls == [] and sent == []